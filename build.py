@@ -1,18 +1,22 @@
 import base64
-import copy
 import hashlib
 import io
+import os
+import struct
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from email.headerregistry import Address
 from pathlib import Path
 from typing import Any, cast
 import tomllib
 
-import jinja2
 import pydantic
 import httpx
 
+USER_AGENT = "pack-binary (0.0.1)"
+
 
 @dataclass(kw_only=True, slots=True, frozen=True)
 class Target:
@@ -31,7 +35,10 @@ class Config:
 @dataclass(kw_only=True, slots=True, frozen=True)
 class File:
     content: bytes
-    executable: bool = False
+    digest: bytes = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "digest", hashlib.sha256(self.content).digest())
 
 
 def main():
@@ -46,125 +53,238 @@ def main():
     output = Path("dist")
     output.mkdir(exist_ok=True, parents=True)
 
-    for target in config.target:
-        name = project["name"]
-        version = project["version"]
-
-        bin_ext = ".exe" if target.name.endswith(".exe") else ""
-        package_name_with_version = name.replace("-", "_") + "-" + version
-
-        files: dict[str, File] = {}
-
-        url = jinja2.Template(target.url).render(**config.context)
-        print("downloading", url)
-
-        resp = httpx.get(url, follow_redirects=True)
-        with io.BytesIO(resp.read()) as f:
-            with zipfile.ZipFile(f) as zf:
-                external_attr = zf.getinfo(target.name).external_attr
-                with zf.open(target.name, "r") as bin:
-                    executable = bin.read()
-
-        executable_path = Path(
-            package_name_with_version + ".data",
-            "scripts",
-            config.cmd + bin_ext,
-        ).as_posix()
-
-        files[executable_path] = File(content=executable, executable=True)
-
-        dist_info_path = Path(package_name_with_version + ".dist-info")
-
-        tags = target.tag if isinstance(target.tag, list) else [target.tag]
-        full_tags = ["py3-none-" + t for t in tags]
-
-        files[dist_info_path.joinpath("WHEEL").as_posix()] = File(
-            content="\n".join(
-                [
-                    "Wheel-Version: 1.0",
-                    "Generator: pack-binary (0.0.1)",
-                    "Root-Is-Purelib: false",
-                ]
-                + ["Tag: {}".format(t) for t in full_tags]
-                + [""]
-            ).encode()
-        )
+    with httpx.Client(
+        follow_redirects=True,
+        timeout=30.0,
+        headers={"User-Agent": USER_AGENT},
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+    ) as client:
+        with ThreadPoolExecutor(max_workers=len(config.target)) as executor:
+            for future in [
+                executor.submit(build_one, target, project, config, output, client)
+                for target in config.target
+            ]:
+                future.result()
+
+
+def build_one(
+    target: Target,
+    project: dict[str, Any],
+    config: Config,
+    output: Path,
+    client: httpx.Client,
+):
+    name = project["name"]
+    version = project["version"]
+
+    bin_ext = ".exe" if target.name.endswith(".exe") else ""
+    package_name_with_version = name.replace("-", "_") + "-" + version
+
+    files: dict[str, File] = {}
+
+    executable_path = Path(
+        package_name_with_version + ".data",
+        "scripts",
+        config.cmd + bin_ext,
+    ).as_posix()
+
+    dist_info_path = Path(package_name_with_version + ".dist-info")
+
+    tags = target.tag if isinstance(target.tag, list) else [target.tag]
+    full_tags = ["py3-none-" + t for t in tags]
+
+    files[dist_info_path.joinpath("WHEEL").as_posix()] = File(
+        content="\n".join(
+            [
+                "Wheel-Version: 1.0",
+                "Generator: pack-binary (0.0.1)",
+                "Root-Is-Purelib: false",
+            ]
+            + [f"Tag: {t}" for t in full_tags]
+            + [""]
+        ).encode()
+    )
 
-        meta_file = "\n".join(generate_metadata(project)) + "\n"
+    with io.BytesIO() as meta_file:
+        for line in generate_metadata(project):
+            meta_file.write(line.encode())
+            meta_file.write(b"\n")
 
         files[dist_info_path.joinpath("METADATA").as_posix()] = File(
-            content=meta_file.encode()
+            content=meta_file.getvalue()
         )
 
-        records: list[tuple[str, str, str]] = []
+    asset = download(client, target.url.format_map(config.context))
+
+    wheel_tag = "py3-none-" + ".".join(tags)
+    wheel_name = f"{package_name_with_version}-{wheel_tag}.whl"
+    print("writing", wheel_name)
+    with (
+        zipfile.ZipFile(asset) as src_zf,
+        zipfile.ZipFile(
+            output.joinpath(wheel_name),
+            "w",
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=3,
+        ) as zf,
+    ):
+        info = _zip_info(zf, executable_path)
+        if not target.name.endswith(".exe"):
+            info.external_attr = src_zf.getinfo(target.name).external_attr
+        with src_zf.open(target.name, "r") as bin:
+            # typeshed types ZipFile.open() as IO[bytes], which lacks readinto()
+            h = hashlib.file_digest(cast(zipfile.ZipExtFile, bin), "sha256")
+        copy_compressed(src_zf, target.name, zf, info)
+
+        records: list[tuple[str, str, str]] = [
+            (executable_path, "sha256=" + _b64_sha256(h.digest()), str(info.file_size))
+        ]
         for path, file in files.items():
             records.append(
                 (
                     path,
-                    "sha256="
-                    + base64.urlsafe_b64encode(hashlib.sha256(file.content).digest())
-                    .rstrip(b"=")
-                    .decode(),
+                    "sha256=" + _b64_sha256(file.digest),
                     str(len(file.content)),
                 )
             )
 
-        records.append((dist_info_path.joinpath("RECORD").as_posix(), "", ""))
+            zf.writestr(_zip_info(zf, path), file.content)
 
-        files[dist_info_path.joinpath("RECORD").as_posix()] = File(
-            content="\n".join(",".join(record) for record in records).encode() + b"\n"
+        record_path = dist_info_path.joinpath("RECORD").as_posix()
+        records.append((record_path, "", ""))
+
+        zf.writestr(
+            _zip_info(zf, record_path),
+            "\n".join(",".join(record) for record in records).encode() + b"\n",
         )
 
-        wheel_tag = "py3-none-" + ".".join(tags)
-        wheel_name = "{}-{}.whl".format(package_name_with_version, wheel_tag)
-        print("writing", wheel_name)
-        with zipfile.ZipFile(
-            output.joinpath(wheel_name), "w", compression=zipfile.ZIP_DEFLATED
-        ) as zf:
-            for name, file in files.items():
-                info = zipfile.ZipInfo(name)
-                if file.executable and not target.name.endswith(".exe"):
-                    info.external_attr = external_attr
-                with zf.open(info, "w") as dest:
-                    dest.write(file.content)
-
-
-def load_pyproject():
-    p = tomllib.loads(
-        Path(__file__, "..", "pyproject.toml").resolve().read_text("utf8")
+
+def download(client: httpx.Client, url: str) -> Path:
+    # release assets are immutable once published, cache them by url
+    cache_dir = Path(
+        os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache", "dprint-py"
     )
+    cached = cache_dir.joinpath(hashlib.sha256(url.encode()).hexdigest() + ".zip")
+    if cached.exists():
+        print("using cached", url)
+        return cached
+
+    print("downloading", url)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # unique temp name, so concurrent builds never write into the same file
+    f = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False)
+    tmp = Path(f.name)
+    try:
+        with f, client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_bytes(chunk_size=1024 * 1024):
+                f.write(chunk)
+        tmp.replace(cached)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return cached
+
+
+def copy_compressed(
+    src_zf: zipfile.ZipFile, name: str, zf: zipfile.ZipFile, info: zipfile.ZipInfo
+):
+    # copy the member's compressed bytes as-is, so the binary doesn't get
+    # inflated and deflated again just to end up with the same data.
+    src_info = src_zf.getinfo(name)
+    if src_info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise ValueError(
+            f"compression {src_info.compress_type} of {name} is not supported in wheel"
+        )
+
+    info.compress_type = src_info.compress_type
+    info.CRC = src_info.CRC
+    info.compress_size = src_info.compress_size
+    info.file_size = src_info.file_size
+    if not info.external_attr:
+        info.external_attr = 0o600 << 16  # same default as ZipFile.open()
+
+    assert src_zf.fp is not None and zf.fp is not None
+    assert info.filename not in zf.NameToInfo, f"duplicate entry {info.filename}"
+
+    # ZipFile has no public API for raw copies, so this writes through its
+    # undocumented fp, start_dir, filelist and NameToInfo attributes and skips
+    # the _writing guard, _lock, _writecheck() and allowZip64 check done by
+    # open(mode="w"). This is safe on the pinned 3.14.6: entries are written at
+    # start_dir and close() writes the central directory from filelist, as
+    # open(mode="w") does; zf is owned by a single build_one() call, so no
+    # other thread or write handle touches it; duplicates are the assert above;
+    # and FileHeader() adds zip64 extras itself when the sizes need them.
+
+    src_zf.fp.seek(src_info.header_offset)
+    header = src_zf.fp.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise ValueError(f"bad local file header for {name}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    src_zf.fp.seek(name_length + extra_length, os.SEEK_CUR)
+
+    zf.fp.seek(zf.start_dir)
+    info.header_offset = zf.fp.tell()
+    zf.fp.write(info.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = src_zf.fp.read(min(remaining, 256 * 1024))
+        if not chunk:
+            raise EOFError(f"truncated data for {name}")
+        zf.fp.write(chunk)
+        remaining -= len(chunk)
+    zf.start_dir = zf.fp.tell()
+
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+
+
+def _zip_info(zf: zipfile.ZipFile, path: str) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(path)
+    info.compress_type = zf.compression
+    info.compress_level = zf.compresslevel
+    return info
+
+
+def _b64_sha256(digest: bytes) -> str:
+    # a sha256 digest always encodes to 43 characters plus one "=" of padding
+    return base64.urlsafe_b64encode(digest)[:43].decode("ascii")
+
+
+def load_pyproject() -> dict[str, Any]:
+    with Path(__file__, "..", "pyproject.toml").resolve().open("rb") as f:
+        p = tomllib.load(f)
 
     return p
 
 
 def generate_metadata(project: dict[str, Any]):
-    meta = copy.deepcopy(project)
+    meta = project.copy()
     yield "Metadata-Version: 2.4"
 
     name = meta.pop("name")
-    yield "Name: {}".format(name)
+    yield f"Name: {name}"
 
     version = meta.pop("version")
-    yield "Version: {}".format(version)
+    yield f"Version: {version}"
 
     requires_version = meta.pop("requires-python")
-    yield "Requires-Python: {}".format(requires_version)
+    yield f"Requires-Python: {requires_version}"
 
     classifiers = meta.pop("classifiers", [])
     for classifier in classifiers:
-        yield "Classifier: {}".format(classifier)
+        yield f"Classifier: {classifier}"
 
     summary = meta.pop("description", None)
     if summary:
-        yield "Summary: {}".format(summary)
+        yield f"Summary: {summary}"
 
     license_field = meta.pop("license", None)
     if license_field:
-        yield "License: {}".format(license_field)
+        yield f"License: {license_field}"
 
     keywords = meta.pop("keywords", None)
     if keywords:
-        yield "Keywords: {}".format(",".join(keywords))
+        yield "Keywords: " + ",".join(keywords)
 
     for label, key in [("Author", "authors"), ("Maintainer", "maintainers")]:
         people: list[dict[str, str]] = cast(list[dict[str, str]], meta.pop(key, []))
@@ -172,16 +292,14 @@ def generate_metadata(project: dict[str, Any]):
             author_name = person.get("name", "")
             author_email = person.get("email")
             if author_email:
-                yield "{}: {}".format(
-                    label,
-                    Address(display_name=author_name, addr_spec=author_email),
-                )
+                address = Address(display_name=author_name, addr_spec=author_email)
+                yield f"{label}: {address}"
             else:
-                yield "{}: {}".format(label, author_name)
+                yield f"{label}: {author_name}"
 
     urls = meta.pop("urls", {})
     for url_name, url in urls.items():
-        yield "Project-URL: {}, {}".format(url_name, url)
+        yield f"Project-URL: {url_name}, {url}"
 
     readme = meta.pop("readme", None)
     if readme:
@@ -191,7 +309,7 @@ def generate_metadata(project: dict[str, Any]):
 
     if meta:
         raise ValueError(
-            "keys {} from pyproject.toml is not supported".format(list(meta.keys()))
+            f"keys {list(meta.keys())} from pyproject.toml is not supported"
         )
 
 